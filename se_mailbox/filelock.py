@@ -11,6 +11,42 @@ import os
 import time
 import fcntl
 import errno
+import ctypes
+import random
+import select
+import struct
+
+# Number of times to retry immediately before waiting, and the initial wait,
+# which doubles after every attempt until it reaches the lock's `delay`.
+SPIN_ATTEMPTS = 10
+INITIAL_BACKOFF = 0.00005
+
+# inotify(7) constants, from <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# struct inotify_event: wd, mask, cookie, len, followed by the name.
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def _load_libc():
+    """Return the C library if it provides inotify, otherwise None."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, TypeError, AttributeError):
+        return None
+    return libc
+
+
+_libc = _load_libc()
 
 
 class FileLockException(Exception):
@@ -18,18 +54,90 @@ class FileLockException(Exception):
     pass
 
 
+class _LockfileWatch(object):
+    """Wait for a lockfile to be released.
+
+    Where inotify is available, the directory containing the lockfile is
+    watched so that waiting returns as soon as the lockfile is removed.
+    Otherwise, waiting simply sleeps for the given time.
+    """
+
+    def __init__(self, path, mask):
+        self.fd = None
+        self.name = os.fsencode(os.path.basename(path))
+        if _libc is None:
+            return
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return
+        dirname = os.fsencode(os.path.dirname(path) or os.curdir)
+        if _libc.inotify_add_watch(fd, dirname, mask) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+
+    def wait(self, timeout):
+        """Wait until the lockfile is released or `timeout` seconds pass.
+
+        Returning does not guarantee that the lock is free; the caller
+        should always try to lock the file again."""
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        # Unlike select(), poll() works with any file descriptor number.
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        end_time = time.time() + timeout
+        while timeout > 0:
+            if poller.poll(timeout * 1000) and self._drain():
+                return
+            timeout = end_time - time.time()
+
+    def _drain(self):
+        """Read all pending events, returning True if any of them was
+        for the lockfile."""
+        found = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                return found
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+                offset += _INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if name == self.name or mask & IN_Q_OVERFLOW:
+                    found = True
+
+    def close(self):
+        """Stop watching the lockfile."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
 class FileLock(object):
     """A file locking mechanism that has context-manager support so
     you can use it in a with statement.
     """
 
+    # The suffix added to the name of the file to get the lockfile name.
+    lockfile_suffix = ".lock"
+    # The inotify events that indicate that the lock may have been released.
+    release_events = IN_DELETE | IN_MOVED_FROM
+
     def __init__(self, file_name, timeout=10, delay=0.05, base=None):
         """Prepare the file locker. Specify the file to lock and optionally
         the maximum timeout and the delay between each attempt to lock."""
         if base is None:
-            base = os.getcwd()
+            # An absolute path ignores the base anyway, so avoid the
+            # getcwd() call in that (common) case.
+            base = "" if os.path.isabs(file_name) else os.getcwd()
         self.is_locked = False
-        self.lockfile = os.path.join(base, "%s.lock" % file_name)
+        self.lockfile = os.path.join(base, "%s%s" % (file_name,
+                                                     self.lockfile_suffix))
         self.file_name = file_name
         self.timeout = timeout
         self.delay = delay
@@ -37,24 +145,55 @@ class FileLock(object):
 
     def acquire(self):
         """Acquire the lock, if possible. If the lock is in use, it check
-        again every `wait` seconds. It does this until it either gets the
-        lock or exceeds `timeout` number of seconds, in which case it throws
-        an exception."""
+        again when the lockfile is removed, or after an increasing wait of
+        up to `delay` seconds. It does this until it either gets the lock
+        or exceeds `timeout` number of seconds, in which case it throws an
+        exception."""
         start_time = time.time()
-        while True:
-            try:
-                self.fd = open(self.lockfile, "w+b")
-                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-            except (OSError, IOError) as e:
-                if e.errno != errno.EWOULDBLOCK:
-                    raise
-                if (time.time() - start_time) >= self.timeout:
-                    raise FileLockException("Timeout occurred.")
-                time.sleep(self.delay)
-            else:
-                break
+        attempts = 0
+        backoff = INITIAL_BACKOFF
+        watch = None
+        try:
+            while True:
+                try:
+                    self._lock()
+                except (OSError, IOError) as e:
+                    if e.errno != errno.EWOULDBLOCK:
+                        raise
+                    remaining = self.timeout - (time.time() - start_time)
+                    if remaining <= 0:
+                        raise FileLockException("Timeout occurred.")
+                    attempts += 1
+                    if attempts < SPIN_ATTEMPTS:
+                        # Most critical sections are short, so the lock is
+                        # likely to be free again almost immediately.
+                        continue
+                    if watch is None:
+                        # Start watching before trying again, so that a
+                        # release in between the two attempts isn't missed.
+                        watch = _LockfileWatch(self.lockfile,
+                                               self.release_events)
+                        continue
+                    # The timeout also makes sure that we try again
+                    # periodically if the lock is released without the
+                    # lockfile being removed (e.g. the holder died).  The
+                    # jitter stops competing processes retrying in step.
+                    watch.wait(min(backoff * (0.5 + random.random()),
+                                   remaining))
+                    backoff = min(backoff * 2, self.delay)
+                else:
+                    break
+        finally:
+            if watch is not None:
+                watch.close()
         self.is_locked = True
 
+    def _lock(self):
+        """Make a single attempt to lock the lockfile, failing with
+        EWOULDBLOCK if someone else holds the lock."""
+        self.fd = open(self.lockfile, "w+b")
+        fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
     def release(self):
         """Get rid of the lock by deleting the lockfile.
         When working in a `with` statement, this gets automatically called
@@ -86,3 +225,70 @@ class FileLock(object):
         """Make sure that the FileLock instance doesn't leave a lockfile
         lying around."""
         self.release()
+
+
+class DirectFileLock(FileLock):
+    """A FileLock that locks the file itself rather than a separate
+    lockfile, so nothing needs to be created or removed to lock it.
+
+    The file is opened (and created, if necessary) using `flags`, and while
+    the lock is held the file descriptor is available as `fd`, so that the
+    file can be read and written through it.  If the file is replaced (e.g.
+    by renaming another file over it), the new file is locked instead.
+    """
+
+    lockfile_suffix = ""
+    # The holder releases the lock by closing the file, and if the file is
+    # replaced then the new file should be locked instead.
+    release_events = IN_CLOSE_WRITE | IN_CLOSE_NOWRITE | IN_MOVED_TO
+
+    def __init__(self, file_name, timeout=10, delay=0.05, base=None,
+                 flags=os.O_RDWR | os.O_CREAT):
+        """Prepare the file locker. Specify the file to lock and optionally
+        the maximum timeout, the delay between each attempt to lock, and
+        the flags used to open the file."""
+        super(DirectFileLock, self).__init__(file_name, timeout, delay, base)
+        self.flags = flags
+
+    def acquire(self):
+        """Acquire the lock, as FileLock.acquire does."""
+        try:
+            super(DirectFileLock, self).acquire()
+        except BaseException:
+            self._close()
+            raise
+
+    def _lock(self):
+        """Make a single attempt to lock the file, failing with EWOULDBLOCK
+        if someone else holds the lock."""
+        while True:
+            if self.fd is not None and not self._is_current():
+                self._close()
+            if self.fd is None:
+                self.fd = os.open(self.lockfile, self.flags, 0o666)
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # The file may have been replaced while we were locking it.
+            if self._is_current():
+                return
+
+    def _is_current(self):
+        """Return True if the open file is still the one at the path."""
+        try:
+            path_stat = os.stat(self.lockfile)
+        except FileNotFoundError:
+            return False
+        return os.path.samestat(os.fstat(self.fd), path_stat)
+
+    def _close(self):
+        """Close the file, which also releases any lock on it."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def release(self):
+        """Release the lock by closing the file.
+        When working in a `with` statement, this gets automatically called
+        at the end."""
+        if hasattr(self, "is_locked") and self.is_locked:
+            self._close()
+            self.is_locked = False
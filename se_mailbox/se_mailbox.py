@@ -17,9 +17,10 @@ where it does not matter for our purposes.
 import os
 import stat
 import time
+import socket
 import mailbox
-
-import scandir
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from . import filelock
 from . import smaildir
@@ -32,12 +33,30 @@ class QuotaMixin(object):
 
     Quotas are not enforced - this would be good to add, but since we do
     a non-standard operation (dropping old data instead of failing to add)
-    there's not much point."""
+    there's not much point.
+
+    The changes made by add() and remove() are buffered, and only written
+    to the maildirsize file once `quota_flush_count` changes are pending,
+    or the oldest pending change is more than `quota_flush_age` seconds
+    old when another change is made, or the mailbox is flushed or closed.
+    An idle mailbox can therefore hold pending changes indefinitely.  Any
+    changes still pending when the mailbox is garbage collected are written
+    then (unless the maildirsize file is locked), but callers should
+    close() (or flush()) the mailbox when they are done with it, so that
+    the changes are written promptly and any errors are not lost."""
+
+    quota_flush_count = 32
+    quota_flush_age = 1
+    # The maximum number of subfolders to recalculate at the same time.
+    recalculate_workers = 8
 
     def __init__(self):
         self.size_fn = os.path.join(self._path, "maildirsize")
         self.size_quota = None
         self.count_quota = None
+        self._pending = []
+        self._pending_time = 0
+        self._quota_key = None
         self.get_quota()
 
     def recalculate(self):
@@ -51,66 +70,124 @@ class QuotaMixin(object):
         # subdirectory and only record the counts if the modification time
         # at the end of the calculation hasn't changed since the start. We
         # are not that concerned with being exact, so we skip that too.
+        # Any pending changes will be included in the new totals.
+        self._pending = []
+        subfolders = [subfolder for subfolder in self.list_folders()
+                      if subfolder != "Trash"]
+        if len(subfolders) > 1:
+            # Each folder is independent, and the time is almost all spent
+            # waiting for system calls, so recalculate them in parallel
+            # (while this folder is scanned).
+            with ThreadPoolExecutor(self.recalculate_workers) as executor:
+                results = executor.map(self._recalculate_folder, subfolders)
+                usage = self._usage()
+        else:
+            usage = self._usage()
+            results = [self._recalculate_folder(subfolder)
+                       for subfolder in subfolders]
+        total_size, total_count = usage
+        for size, count in results:
+            total_size += size
+            total_count += count
+        # The quotas are written back to the file, so make sure that they
+        # are current, even if the file looks unchanged (e.g. the header
+        # was rewritten in place within the timestamp resolution).
+        self._quota_key = None
+        self.get_quota()
+        data = (self._quota_header() +
+                f"{total_size} {total_count}\n").encode()
+        # If recalculations race, the last one to write the file wins,
+        # which is fine.
+        self._write_size_file(data)
+        return total_size, total_count
+
+    def _write_size_file(self, data):
+        """Replace the maildirsize file with the given data."""
+        # Write the new file in "tmp" (which is on the same filesystem) and
+        # rename it into place, so that readers only ever see a complete
+        # file, without needing a lock.  If we die before the rename,
+        # clean() will eventually remove the file.  The name only needs to
+        # be unique between the processes (and threads) that might be
+        # writing at the same time.
+        tmp_fn = os.path.join(self._paths["tmp"], "maildirsize.%s.%d.%d" % (
+            socket.gethostname(), os.getpid(), threading.get_ident()))
+        try:
+            old_stat = os.stat(self.size_fn)
+        except FileNotFoundError:
+            old_stat = None
+        try:
+            fd = os.open(tmp_fn, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o666)
+            try:
+                if old_stat is not None:
+                    # The file may be shared with other users, so keep the
+                    # existing permissions (and group, if we can).
+                    os.fchmod(fd, stat.S_IMODE(old_stat.st_mode))
+                    if os.fstat(fd).st_gid != old_stat.st_gid:
+                        try:
+                            os.fchown(fd, -1, old_stat.st_gid)
+                        except PermissionError:
+                            pass
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            os.replace(tmp_fn, self.size_fn)
+        except OSError:
+            try:
+                os.remove(tmp_fn)
+            except OSError:
+                pass
+            raise
+
+    def _usage(self):
+        """Return the space used by the messages in this folder, excluding
+        subfolders (bytes, number of messages)."""
         total_size = 0
         total_count = 0
         for folder in ("cur", "new"):
-            for filename in scandir.scandir(os.path.join(self._path, folder)):
-                full_fn = os.path.join(self._path, folder, filename.name)
-                total_count += 1
-                # The Maildir++ format allows the size of the message to
-                # be stored in the filename with a 'S=nnnn' format, along
-                # with the Maildir flags.  However, the specification is
-                # not clear on exactly how this is meant to be laid out.
-                # In any case, the Python maildir class doesn't write this
-                # data out, so we would need to add it there as well for it
-                # to be of any use.  We will just use stat() to get the
-                # size.
-                total_size += os.stat(full_fn).st_size
-        for subfolder in self.list_folders():
-            if subfolder == "Trash":
-                continue
-            size, count = self.get_folder(subfolder).recalculate()
+            size, count = self._folder_usage(folder)
             total_size += size
             total_count += count
-        self.get_quota()
-        quotas = ["%d%s" % (q, l)
-                  for l, q in (("S", self.size_quota),
-                               ("C", self.count_quota)) if q]
-        # This is meant to use the same temp file generation and then
-        # renaming that Maildir uses, but (a) that doesn't actually
-        # prevent clashes, and (b) we are going to override how that works
-        # later on anyway.
+        return total_size, total_count
+
+    def _recalculate_folder(self, folder):
+        """Recalculate the space used by the named subfolder."""
+        return self.get_folder(folder).recalculate()
+
+    def _folder_usage(self, folder):
+        """Return the space used by the messages in the named subdirectory
+        (bytes, number of messages)."""
+        path = os.path.join(self._path, folder)
+        total_size = 0
+        total_count = 0
+        # The Maildir++ format allows the size of the message to be stored
+        # in the filename with a 'S=nnnn' format, along with the Maildir
+        # flags.  However, the specification is not clear on exactly how
+        # this is meant to be laid out.  In any case, the Python maildir
+        # class doesn't write this data out, so we would need to add it
+        # there as well for it to be of any use.  We will just use stat()
+        # to get the size (relative to the directory, as smaildir does).
+        dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
         try:
-            with filelock.FileLock(self.size_fn):
-                size = open(self.size_fn, "w")
-                size.write(",".join(quotas) + "\n")
-                size.write("%d %d\n" % (total_size, total_count))
-                size.close()
-        except filelock.FileLockException:
-            # Timed out - skip writing the file, and trust that it will get
-            # regenerated later (when the file is not busy).
-            pass
+            # Listing the descriptor with os.scandir() means that both the
+            # listing and the fstatat() calls are done in C.
+            with os.scandir(dir_fd) as entries:
+                for entry in entries:
+                    total_count += 1
+                    total_size += entry.stat(follow_symlinks=False).st_size
+        finally:
+            os.close(dir_fd)
         return total_size, total_count
 
     def add(self, message, key):
         """Add a message to the folder, recording the space used."""
         filename = super(QuotaMixin, self).add(message, key)
-        full_fn = os.path.join(self._path, self._lookup(filename))
+        # The table of contents normally already has the new message, so
+        # avoid the existence check (and possible refresh) of _lookup().
+        full_fn = os.path.join(self._path, self._toc.get(filename) or
+                               self._lookup(filename))
         msg_size = os.stat(full_fn).st_size
-        try:
-            with filelock.FileLock(self.size_fn):
-                if os.path.exists(self.size_fn):
-                    size = open(self.size_fn, "a")
-                else:
-                    size = open(self.size_fn, "w")
-                    size.write("%s %s\n" % (self.size_quota or "",
-                                            self.count_quota or ""))
-                size.write("%d 1\n" % msg_size)
-                size.close()
-        except filelock.FileLockException:
-            # Timed out - skip writing the new data, and rely on the
-            # periodic recalculation to fix the error.
-            pass
+        self._record_change(msg_size, 1)
         return filename, msg_size
 
     def stat_msg(self, key):
@@ -122,43 +199,116 @@ class QuotaMixin(object):
         """Remove a message from the folder, recording the space freed."""
         full_fn = os.path.join(self._path, self._lookup(key))
         msg_size = os.stat(full_fn).st_size
+        self._record_change(-msg_size, -1)
+        super(QuotaMixin, self).remove(key)
+        return msg_size
+
+    def _record_change(self, size, count):
+        """Record a change in the space used, writing out the pending
+        changes if there are enough of them or they are old enough."""
+        now = time.time()
+        if not self._pending:
+            self._pending_time = now
+        self._pending.append((size, count))
+        if (len(self._pending) >= self.quota_flush_count or
+                now - self._pending_time > self.quota_flush_age):
+            self.flush_quota()
+
+    def flush_quota(self, timeout=10):
+        """Write any pending changes in the space used to the maildirsize
+        file, waiting up to `timeout` seconds for the lock."""
+        if not self._pending:
+            return
+        changes = "".join(f"{size} {count}\n"
+                          for size, count in self._pending).encode()
+        header = self._quota_header().encode()
+        self._pending = []
         try:
-            with filelock.FileLock(self.size_fn):
-                size = open(self.size_fn, "a")
-                size.write("-%d -1\n" % msg_size)
-                size.close()
+            with filelock.DirectFileLock(
+                    self.size_fn, timeout=timeout,
+                    flags=os.O_WRONLY | os.O_APPEND | os.O_CREAT) as lock:
+                if not os.fstat(lock.fd).st_size:
+                    changes = header + changes
+                os.write(lock.fd, changes)
         except filelock.FileLockException:
             # Timed out - skip writing the new data, and rely on the
             # periodic recalculation to fix the error.
             pass
-        super(QuotaMixin, self).remove(key)
-        return msg_size
+
+    def flush(self):
+        """Write any pending changes to disk."""
+        self.flush_quota()
+        super(QuotaMixin, self).flush()
+
+    def close(self):
+        """Flush and close the mailbox."""
+        self.flush()
+        super(QuotaMixin, self).close()
+
+    def __del__(self):
+        """Make sure that pending changes in the space used are not lost
+        if the mailbox is not closed."""
+        if not getattr(self, "_pending", None):
+            return
+        try:
+            # Don't hold up garbage collection waiting for the lock.
+            self.flush_quota(timeout=0)
+        except Exception:
+            # Nothing can be done about errors here (the mailbox may even
+            # have been removed already); recalculation will fix the size.
+            pass
 
     def size(self):
         """Get the size of the folder (bytes, number of messages)."""
-        if not os.path.exists(self.size_fn):
+        try:
+            fd = os.open(self.size_fn, os.O_RDONLY)
+        except FileNotFoundError:
             return self.recalculate()
-        size_stat = os.stat(self.size_fn)
-        if size_stat.st_size > 5120:
+        try:
+            self.flush_quota()
+            size_stat = os.fstat(fd)
+            if size_stat.st_size > 5120:
+                return self.recalculate()
+            data = os.read(fd, size_stat.st_size)
+        finally:
+            os.close(fd)
+        # The first line holds the quotas, and every other line is a
+        # "size count" pair.
+        lines = data.partition(b"\n")[2].splitlines()
+        pairs = [line.split() for line in lines]
+        if any(len(pair) != 2 for pair in pairs):
+            # A line is malformed (e.g. a partial write), so the totals
+            # can't be trusted.
             return self.recalculate()
-        i = 0
-        total_size = 0
-        total_count = 0
-        for i, line in enumerate(open(self.size_fn).readlines()[1:]):
-            size, count = line.split()
-            total_size += int(size)
-            total_count += int(count)
+        total_size = sum(int(size) for size, _ in pairs)
+        total_count = sum(int(count) for _, count in pairs)
         if (((self.count_quota and total_count > self.count_quota) or
              (self.size_quota and total_size > self.size_quota)) and
-                (i == 0 or (time.time() - size_stat.st_mtime) > 15 * 60)):
+                (len(pairs) <= 1 or
+                 (time.time() - size_stat.st_mtime) > 15 * 60)):
             return self.recalculate()
         return total_size, total_count
 
     def get_quota(self):
-        """Load the size_quota and count_quota for this folder."""
+        """Load the size_quota and count_quota for this folder.
+
+        The quotas are only read again if the maildirsize file has been
+        modified or replaced since they were last loaded."""
+        try:
+            size_stat = os.stat(self.size_fn)
+        except OSError:
+            key = None
+        else:
+            # The modification time alone may not change if the file is
+            # rewritten within the filesystem's timestamp resolution.
+            key = (size_stat.st_ino, size_stat.st_size,
+                   size_stat.st_mtime_ns)
+        if key is not None and key == self._quota_key:
+            return
         self.size_quota = None
         self.count_quota = None
-        if not os.path.exists(self.size_fn):
+        self._quota_key = None
+        if key is None:
             return
         try:
             with open(self.size_fn, "r") as size:
@@ -167,6 +317,7 @@ class QuotaMixin(object):
             # Either the file is invalid or another process is updating
             # it right now.
             return
+        self._quota_key = key
         for quota in quotas:
             if not quota:
                 continue
@@ -175,23 +326,33 @@ class QuotaMixin(object):
             elif quota[-1] == "C":
                 self.count_quota = int(quota[:-1])
 
+    def _quota_header(self):
+        """Return the maildirsize header line for the current quotas."""
+        if not self.size_quota and not self.count_quota:
+            return "\n"
+        parts = []
+        if self.size_quota:
+            parts.append(f"{self.size_quota}S")
+        if self.count_quota:
+            parts.append(f"{self.count_quota}C")
+        return ",".join(parts) + "\n"
+
     def set_quota(self, size_quota, count_quota):
         """Set the size_quota and count_quota for this folder."""
         self.size_quota = size_quota
         self.count_quota = count_quota
-        quotas = ["%d%s" % (q, l)
-                  for l, q in (("S", size_quota), ("C", count_quota)) if q]
-        with filelock.FileLock(self.size_fn):
-            if os.path.exists(self.size_fn):
-                size = open(self.size_fn, "r")
-                lines = size.readlines()
-                size.close()
-            else:
-                lines = [""]
-            lines[0] = ",".join(quotas) + "\n"
-            size = open(self.size_fn, "w")
-            size.write("".join(lines))
-            size.close()
+        header = self._quota_header().encode()
+        with filelock.DirectFileLock(self.size_fn) as lock:
+            # If the new header is the same length as the old one (which
+            # is usual when changing a quota), it can be overwritten in
+            # place.  Otherwise, the whole file needs to be rewritten.
+            old_header = os.pread(lock.fd, len(header), 0)
+            if old_header.find(b"\n") == len(header) - 1:
+                if old_header != header:
+                    os.pwrite(lock.fd, header, 0)
+                return
+            data = os.read(lock.fd, os.fstat(lock.fd).st_size)
+            self._write_size_file(header + data.partition(b"\n")[2])
 
 
 class SubclassableMaildir(smaildir.Maildir):
@@ -208,47 +369,18 @@ class SubclassableMaildir(smaildir.Maildir):
             'new': os.path.join(self._path, 'new'),
             'cur': os.path.join(self._path, 'cur'),
             }
-        exists = os.path.exists(self._path)
         is_mailbox = (os.path.exists(self._paths["tmp"]) and
                       os.path.exists(self._paths["new"]) and
                       os.path.exists(self._paths["cur"]))
         if not is_mailbox:
             if create:
                 mask = os.umask(0o000)
-                if not exists:
-                    try:
-                        os.mkdir(self._path, access)
-                    except OSError as e:
-                        # If another process has simultaneously created
-                        # this mailbox, that's fine.
-                        if e.errno != 17:
-                            raise
-                os.chmod(self._path, stat.S_IRWXU | stat.S_IRWXG |
-                         stat.S_IRWXG | stat.S_ISGID)
-                if uid and gid:
-                    os.chown(self._path, uid, gid)
-                elif uid:
-                    os.chown(self._path, uid, -1)
-                elif gid:
-                    os.chown(self._path, -1, gid)
-                for path in self._paths.values():
-                    if not os.path.exists(path):
-                        try:
-                            os.mkdir(path, access)
-                        except OSError as e:
-                            # If another process has simultaneously created
-                            # this mailbox, that's fine.
-                            if e.errno != 17:
-                                raise
-                    os.chmod(path, stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXG |
-                             stat.S_ISGID)
-                    if uid and gid:
-                        os.chown(path, uid, gid)
-                    elif uid:
-                        os.chown(path, uid, -1)
-                    elif gid:
-                        os.chown(path, -1, gid)
-                os.umask(mask)
+                try:
+                    for path in (self._path, self._paths["tmp"],
+                                 self._paths["new"], self._paths["cur"]):
+                        self._create_dir(path, access, uid, gid)
+                finally:
+                    os.umask(mask)
             else:
                 raise mailbox.NoSuchMailboxError(self._path)
         self._toc = {}
@@ -256,6 +388,24 @@ class SubclassableMaildir(smaildir.Maildir):
         self._last_read = 0  # Records last time we read cur/new
         self._skewfactor = 0.1  # Adjust if os/fs clocks are skewing
 
+    @staticmethod
+    def _create_dir(path, access, uid, gid):
+        """Create the directory if it doesn't already exist, and set its
+        permissions and ownership."""
+        try:
+            os.mkdir(path, access)
+        except FileExistsError:
+            # If another process has simultaneously created this directory,
+            # that's fine.
+            pass
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fchmod(fd, stat.S_IRWXU | stat.S_IRWXG | stat.S_ISGID)
+            if uid or gid:
+                os.fchown(fd, uid or -1, gid or -1)
+        finally:
+            os.close(fd)
+
     def __getitem__(self, key):
         """Like the parent, but ensures that the date is set when using the
         factory (the factory is no longer able to set the date).  This is
@@ -19,8 +19,37 @@ class Maildir(mailbox.Maildir):
     Also provides a new iter_folders() method that works like
     list_folders() but provides a generator rather than returning a
     list.
+
+    The table of contents is also kept for "cur" and "new" separately, so
+    that a refresh only needs to re-read the subdirectories that changed.
+
+    Where every entry in a directory is operated on, this is done relative
+    to an open descriptor for the directory, so that the full path does not
+    need to be resolved for each entry.
     """
 
+    # The table of contents for each subdirectory, which is created by the
+    # first refresh (so subclasses do not need to set it up).
+    _subdir_tocs = None
+
+    def add(self, message):
+        """Add message and return assigned key."""
+        key = super(Maildir, self).add(message)
+        # Record where the message was delivered (in the same way that the
+        # parent does), so that looking it up doesn't need to re-read the
+        # "new" and "cur" directories.
+        subdir = 'new'
+        suffix = ''
+        if isinstance(message, mailbox.MaildirMessage):
+            subdir = message.get_subdir()
+            if message.get_info():
+                suffix = self.colon + message.get_info()
+        subpath = os.path.join(subdir, key + suffix)
+        self._toc[key] = subpath
+        if self._subdir_tocs is not None and subdir in self._subdir_tocs:
+            self._subdir_tocs[subdir][key] = subpath
+        return key
+
     def list_folders(self):
         """Return a list of folder names."""
         return list(self.iter_folders())
@@ -28,10 +57,11 @@ class Maildir(mailbox.Maildir):
     def iter_folders(self):
         """Return a generator of folder names."""
         for entry in scandir.scandir(self._path):
-            entry = entry.name
-            if len(entry) > 1 and entry[0] == '.' and \
-               os.path.isdir(os.path.join(self._path, entry)):
-                yield entry[1:]
+            name = entry.name
+            # The entry normally knows its type from the directory listing,
+            # so is_dir() only needs to stat() symlinks.
+            if len(name) > 1 and name[0] == '.' and entry.is_dir():
+                yield name[1:]
 
     def remove_folder(self, folder):
         """Delete the named folder, which must be empty."""
@@ -50,20 +80,31 @@ class Maildir(mailbox.Maildir):
                 raise mailbox.NotEmptyError("Folder contains subdirectory "
                                             "'%s': %s" % (folder, entry))
         for root, dirs, files in scandir.walk(path, topdown=False):
-            for entry in files:
-                os.remove(os.path.join(root, entry))
-            for entry in dirs:
-                os.rmdir(os.path.join(root, entry))
+            if not files and not dirs:
+                continue
+            dir_fd = os.open(root, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                for entry in files:
+                    os.remove(entry, dir_fd=dir_fd)
+                for entry in dirs:
+                    os.rmdir(entry, dir_fd=dir_fd)
+            finally:
+                os.close(dir_fd)
         os.rmdir(path)
 
     def clean(self):
         """Delete old files in "tmp"."""
         now = time.time()
-        for entry in scandir.scandir(os.path.join(self._path, 'tmp')):
-            entry = entry.name
-            path = os.path.join(self._path, 'tmp', entry)
-            if now - os.path.getatime(path) > 129600:  # 60 * 60 * 36
-                os.remove(path)
+        tmp_path = os.path.join(self._path, 'tmp')
+        dir_fd = os.open(tmp_path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            for entry in scandir.scandir(tmp_path):
+                entry = entry.name
+                atime = os.stat(entry, dir_fd=dir_fd).st_atime
+                if now - atime > 129600:  # 60 * 60 * 36
+                    os.remove(entry, dir_fd=dir_fd)
+        finally:
+            os.close(dir_fd)
 
     def _refresh(self):
         """Update table of contents mapping."""
@@ -80,23 +121,32 @@ class Maildir(mailbox.Maildir):
         # extra delta to our wait.  The default is one tenth second, but is an
         # instance variable and so can be adjusted if dealing with a
         # particularly skewed or irregular system.
+        # Outside of that window, only the subdirectories whose mtime has
+        # changed are re-read.
         if time.time() - self._last_read > 2 + self._skewfactor:
-            refresh = False
+            subdirs = []
             for subdir in self._toc_mtimes:
                 mtime = os.path.getmtime(self._paths[subdir])
                 if mtime > self._toc_mtimes[subdir]:
-                    refresh = True
+                    subdirs.append(subdir)
                 self._toc_mtimes[subdir] = mtime
-            if not refresh:
+            if not subdirs:
                 return
+        else:
+            subdirs = list(self._toc_mtimes)
+        if self._subdir_tocs is None:
+            # Nothing has been read yet, so read everything.
+            self._subdir_tocs = {}
+            subdirs = list(self._toc_mtimes)
         # Refresh toc
+        colon = self.colon
+        for subdir in subdirs:
+            prefix = subdir + os.sep
+            self._subdir_tocs[subdir] = {
+                entry.name.partition(colon)[0]: prefix + entry.name
+                for entry in scandir.scandir(self._paths[subdir])
+                if not entry.is_dir()}
         self._toc = {}
         for subdir in self._toc_mtimes:
-            path = self._paths[subdir]
-            for entry in scandir.scandir(path):
-                if entry.is_dir():
-                    continue
-                entry = entry.name
-                uniq = entry.split(self.colon)[0]
-                self._toc[uniq] = os.path.join(subdir, entry)
+            self._toc.update(self._subdir_tocs[subdir])
         self._last_read = time.time()
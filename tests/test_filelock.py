@@ -1,5 +1,13 @@
+import os
+import time
+import errno
+import pathlib
+import shutil
+import resource
+import tempfile
 import unittest
-from mock import patch, MagicMock
+import threading
+from mock import patch, Mock
 
 from se_mailbox import filelock
 
@@ -7,27 +15,51 @@ from se_mailbox import filelock
 class TestFileLock(unittest.TestCase):
     """"""
 
+    @classmethod
+    def setUpClass(cls):
+        fd, cls._path = tempfile.mkstemp(prefix="flock_")
+        os.close(fd)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.unlink(cls._path)
+
     def setUp(self):
-        self.tested_obj = filelock.FileLock("filename")
+        self.mock_open = patch("se_mailbox.filelock.open",
+                               create=True).start()
+        self.mock_flock = patch("se_mailbox.filelock.fcntl.flock").start()
+        self.tested_obj = filelock.FileLock(self._path)
 
     def tearDown(self):
-        self.tested_obj.release()
+        if getattr(self.tested_obj, "is_locked", False):
+            self.tested_obj.release()
         patch.stopall()
 
     def test_acquire(self):
         """Test that we can't acquire a lock on the same file."""
-        f2 = filelock.FileLock("filename", timeout=0.1)
+        self.mock_flock.side_effect = [
+            None, BlockingIOError(errno.EWOULDBLOCK, "EWOULDBLOCK")]
+        f2 = filelock.FileLock(self._path, timeout=0)
 
         self.tested_obj.acquire()
 
         with self.assertRaises(filelock.FileLockException):
             f2.acquire()
 
+    def test_lockfile(self):
+        """Test the lockfile name for relative, absolute and Path paths."""
+        self.assertEqual(filelock.FileLock("filename").lockfile,
+                         os.path.join(os.getcwd(), "filename.lock"))
+        self.assertEqual(self.tested_obj.lockfile, self._path + ".lock")
+        path = pathlib.Path("/tmp/filename")
+        self.assertEqual(filelock.FileLock(path).lockfile,
+                         "/tmp/filename.lock")
+
     def test_context_locking(self):
         """Test that using a FileLock object in a context
         will call acquire and release upon enter and exit."""
-        self.tested_obj.acquire = MagicMock()
-        self.tested_obj.release = MagicMock()
+        self.tested_obj.acquire = Mock(spec=lambda *a, **kw: None)
+        self.tested_obj.release = Mock(spec=lambda *a, **kw: None)
 
         with self.tested_obj:
             # the acquire method should have set this
@@ -38,4 +70,134 @@ class TestFileLock(unittest.TestCase):
         self.tested_obj.release.assert_called_once()
 
 
+class LockWaitMixin(object):
+    """Set up a lock of the `lock_class` type on a file in a temporary
+    directory, and check waiting for it."""
+
+    lock_class = None
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.tmp_dir, "filename")
+        self.tested_obj = self.lock_class(self.file_name)
+
+    def tearDown(self):
+        self.tested_obj.release()
+        shutil.rmtree(self.tmp_dir)
+
+    def assert_acquired_after(self, action):
+        """Check that a waiting lock is woken up and acquired straight
+        after the action is done."""
+        f2 = self.lock_class(self.file_name, timeout=10, delay=5)
+
+        self.tested_obj.acquire()
+        threading.Timer(0.1, action).start()
+
+        start_time = time.time()
+        # Without the inotify wakeup, the first wait would be at least
+        # 2.5 seconds.
+        with patch("se_mailbox.filelock.INITIAL_BACKOFF", 5):
+            f2.acquire()
+        self.assertTrue(f2.is_locked)
+        self.assertLess(time.time() - start_time, 1)
+        f2.release()
+
+
+class TestFileLockWait(LockWaitMixin, unittest.TestCase):
+    """Tests for waiting for a filelock.FileLock held by someone else."""
+
+    lock_class = filelock.FileLock
+
+    @unittest.skipIf(filelock._libc is None, "inotify is not available")
+    def test_acquire_after_release(self):
+        """Test that a waiting lock is acquired once the holder releases
+        it."""
+        self.assert_acquired_after(self.tested_obj.release)
+
+
+class TestLockfileWatch(unittest.TestCase):
+    """Tests for the filelock._LockfileWatch class."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.tmp_dir, "filename")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @unittest.skipIf(filelock._libc is None, "inotify is not available")
+    @unittest.skipIf(resource.getrlimit(resource.RLIMIT_NOFILE)[0] <= 2048,
+                     "too few file descriptors are allowed")
+    def test_wait_high_fd(self):
+        """Test waiting with a file descriptor too large for select()."""
+        watch = filelock._LockfileWatch(self.file_name,
+                                        filelock.IN_DELETE)
+        fd = os.dup2(watch.fd, 2048)
+        os.close(watch.fd)
+        watch.fd = fd
+        try:
+            threading.Timer(0.1, os.remove, [self.file_name]).start()
+            open(self.file_name, "w").close()
+
+            start_time = time.time()
+            watch.wait(5)
+            self.assertLess(time.time() - start_time, 1)
+        finally:
+            watch.close()
+
+
+class TestDirectFileLock(LockWaitMixin, unittest.TestCase):
+    """Tests for the filelock.DirectFileLock class."""
+
+    lock_class = filelock.DirectFileLock
+
+    def test_acquire(self):
+        """Test that we can't acquire a lock on the same file, and that no
+        lockfile is created."""
+        f2 = filelock.DirectFileLock(self.file_name, timeout=0)
+
+        self.tested_obj.acquire()
+
+        with self.assertRaises(filelock.FileLockException):
+            f2.acquire()
+        self.assertIsNone(f2.fd)
+        self.assertEqual(os.listdir(self.tmp_dir), ["filename"])
+
+    def test_acquire_replaced(self):
+        """Test that the new file is locked if the file is replaced."""
+        f2 = filelock.DirectFileLock(self.file_name, timeout=0)
+        new_file_name = os.path.join(self.tmp_dir, "new")
+
+        self.tested_obj.acquire()
+        open(new_file_name, "w").close()
+        os.replace(new_file_name, self.file_name)
+
+        f2.acquire()
+        self.assertTrue(os.path.samestat(os.fstat(f2.fd),
+                                         os.stat(self.file_name)))
+        f2.release()
+
+    @unittest.skipIf(filelock._libc is None, "inotify is not available")
+    def test_acquire_after_release(self):
+        """Test that a waiting lock is acquired once the holder closes the
+        file."""
+        self.assert_acquired_after(self.tested_obj.release)
+
+    @unittest.skipIf(filelock._libc is None, "inotify is not available")
+    def test_acquire_after_replace(self):
+        """Test that a waiting lock is acquired once the file is
+        replaced."""
+        new_file_name = os.path.join(self.tmp_dir, "new")
+        open(new_file_name, "w").close()
+
+        self.assert_acquired_after(
+            lambda: os.replace(new_file_name, self.file_name))
+
+    def test_write(self):
+        """Test that the locked file can be written through the lock."""
+        with self.tested_obj:
+            os.write(self.tested_obj.fd, b"data")
 
+        self.assertIsNone(self.tested_obj.fd)
+        with open(self.file_name, "rb") as f:
+            self.assertEqual(f.read(), b"data")
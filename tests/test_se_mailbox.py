@@ -1,23 +1,45 @@
+import io
+import email
 import os
 import stat
 import time
-import shutil
+import tempfile
 import unittest
+from mock import patch, call
 
 from se_mailbox import se_mailbox
 
+# Where possible, create the test mailboxes on a memory-backed filesystem.
+TMPFS_DIR = os.environ.get("TMPFS_DIR", "/dev/shm")
+if not os.path.isdir(TMPFS_DIR):
+    TMPFS_DIR = None
+
+_TEST_MSG = (b"Subject: Test\n"
+             b"To: Testers <testers@spamexperts.com>\n"
+             b"From: Testers <testers@spamexperts.com>\n"
+             b"\n"
+             b"This is a test message.\n")
+_TEST_MSG_OBJ = email.message_from_bytes(_TEST_MSG)
+
+
+class QuotaMaildir(se_mailbox.QuotaMixin, se_mailbox.SubclassableMaildir):
+    """A SubclassableMaildir with quota support."""
+    def __init__(self, dirname, **kwargs):
+        se_mailbox.SubclassableMaildir.__init__(self, dirname, **kwargs)
+        se_mailbox.QuotaMixin.__init__(self)
+
 
 class SubclassableMaildirTest(unittest.TestCase):
     """Test functionality unique to the SubclassableMaildir class."""
     def setUp(self):
         """Setup code"""
-        self.mailbox_dir = os.path.join(os.path.dirname(
-            os.path.join(__file__)), "testmailbox")
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix="se_mbox_",
+                                                   dir=TMPFS_DIR)
+        self.mailbox_dir = os.path.join(self.tmp_dir.name, "testmailbox")
 
     def tearDown(self):
         """Clean up after a single test."""
-        if os.path.exists(self.mailbox_dir):
-            shutil.rmtree(self.mailbox_dir)
+        self.tmp_dir.cleanup()
 
     def test_mail_create_subdirectories(self):
         """Test create mail subdirectories"""
@@ -39,26 +61,58 @@ class SubclassableMaildirTest(unittest.TestCase):
 
         self.assertFalse(os.path.exists(self.mailbox_dir))
 
+    def test_mail_create_missing_parent(self):
+        """Test that the parent of the mailbox is not created"""
+        mailbox_dir = os.path.join(self.mailbox_dir, "testmailbox")
+        with self.assertRaises(FileNotFoundError):
+            se_mailbox.SubclassableMaildir(mailbox_dir, create=True)
+
+        self.assertFalse(os.path.exists(self.mailbox_dir))
+
     def test_message_time_from_file(self):
         """Test message time from file"""
-
-        message = ("Subject: Test\n"
-                   "To: Testers <testers@spamexperts.com>\n"
-                   "From: Testers <testers@spamexperts.com>\n"
-                   "\n"
-                   "This is a test message.\n")
         mbox = se_mailbox.SubclassableMaildir(
             self.mailbox_dir, create=True)
-        key = mbox.add(message)
 
-        # change file time to point to 10 seconds in the future
-        msg_filename = os.path.join(mbox._path, mbox._lookup(key))
+        # make the file time point to 10 seconds in the future
         new_time = time.time() + 10
-        os.utime(msg_filename, (new_time, new_time))
-
-        # check that we get the modified time
-        message = mbox[key]
+        with patch.object(mbox, "_lookup", return_value="new/key"), \
+                patch.object(mbox, "get_file",
+                             return_value=io.BytesIO(_TEST_MSG)), \
+                patch("se_mailbox.se_mailbox.os.path.getmtime",
+                      return_value=new_time) as mock_getmtime:
+            # check that we get the modified time
+            message = mbox["key"]
         self.assertAlmostEqual(new_time, message.get_date(), places=3)
+        self.assertEqual(mock_getmtime.call_args_list,
+                         [call(os.path.join(self.mailbox_dir, "new", "key"))])
+
+    def test_add_records_location(self):
+        """Test that add records where the message was delivered"""
+        mbox = se_mailbox.SubclassableMaildir(
+            self.mailbox_dir, create=True)
+        key = mbox.add(_TEST_MSG_OBJ)
+        message = se_mailbox.mailbox.MaildirMessage(_TEST_MSG_OBJ)
+        message.set_subdir("cur")
+        message.set_flags("S")
+        seen_key = mbox.add(message)
+
+        self.assertEqual(mbox._toc, {
+            key: os.path.join("new", key),
+            seen_key: os.path.join("cur", seen_key + mbox.colon + "2,S"),
+        })
+        self.assertEqual(sorted(mbox.keys()), sorted([key, seen_key]))
+
+    def test_subclass_without_maildir_init(self):
+        """Test a subclass that does not call the smaildir.Maildir init"""
+        class TestMbox(se_mailbox.smaildir.Maildir):
+            def __init__(self, dirname):
+                se_mailbox.mailbox.Maildir.__init__(self, dirname)
+        mbox = TestMbox(self.mailbox_dir)
+        key = mbox.add(_TEST_MSG_OBJ)
+
+        self.assertEqual(len(mbox), 1)
+        self.assertEqual(list(mbox.keys()), [key])
 
     def test_folder_subclass(self):
         """Test add and get a folder from new mbox subclass"""
@@ -76,3 +130,195 @@ class SubclassableMaildirTest(unittest.TestCase):
         child_mbox = mbox.get_folder("test")
 
         self.assertTrue(isinstance(child_mbox, TestMbox))
+
+
+class QuotaMixinTest(unittest.TestCase):
+    """Test the Maildir++ quota functionality of the QuotaMixin class."""
+    def setUp(self):
+        """Setup code"""
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix="se_mbox_",
+                                                   dir=TMPFS_DIR)
+        self.mailbox_dir = os.path.join(self.tmp_dir.name, "testmailbox")
+        self.mbox = QuotaMaildir(self.mailbox_dir, create=True)
+
+    def tearDown(self):
+        """Clean up after a single test."""
+        self.tmp_dir.cleanup()
+
+    def write_size_file(self, data):
+        """Replace the maildirsize file with the given data."""
+        with open(self.mbox.size_fn, "w") as size:
+            size.write(data)
+
+    def test_size(self):
+        """Test that size sums the maildirsize entries."""
+        self.write_size_file("\n100 1\n250 1\n-100 -1\n")
+
+        self.assertEqual(self.mbox.size(), (250, 1))
+
+    def test_size_malformed(self):
+        """Test that size recalculates if an entry is malformed."""
+        self.write_size_file("\n100 1\n250\n-100 -1\n")
+
+        self.assertEqual(self.mbox.size(), (0, 0))
+
+    def test_size_over_quota(self):
+        """Test that size recalculates a single entry over quota."""
+        self.mbox.set_quota(None, 1)
+        self.write_size_file("1C\n100 2\n")
+
+        self.assertEqual(self.mbox.size(), (0, 0))
+
+    def test_get_quota_unchanged(self):
+        """Test that get_quota only reloads a modified maildirsize."""
+        self.write_size_file("10S,2C\n")
+        self.mbox.get_quota()
+        self.mbox.size_quota = None
+
+        self.mbox.get_quota()
+        self.assertEqual(self.mbox.size_quota, None)
+
+        os.utime(self.mbox.size_fn, ns=(0, 0))
+        self.mbox.get_quota()
+        self.assertEqual((self.mbox.size_quota, self.mbox.count_quota),
+                         (10, 2))
+
+    def test_get_quota_replaced(self):
+        """Test that get_quota reloads a replaced maildirsize, even if the
+        modification time is the same."""
+        self.write_size_file("10S,2C\n")
+        self.mbox.get_quota()
+        mtime_ns = os.stat(self.mbox.size_fn).st_mtime_ns
+        new_fn = os.path.join(self.mailbox_dir, "tmp", "maildirsize")
+        with open(new_fn, "w") as size:
+            size.write("20S,3C\n")
+        os.utime(new_fn, ns=(mtime_ns, mtime_ns))
+        os.replace(new_fn, self.mbox.size_fn)
+
+        self.mbox.get_quota()
+        self.assertEqual((self.mbox.size_quota, self.mbox.count_quota),
+                         (20, 3))
+
+    def test_recalculate(self):
+        """Test that recalculate counts the messages in new and cur."""
+        for subdir, data in (("new", "a" * 10), ("cur", "b" * 20)):
+            with open(os.path.join(self.mailbox_dir, subdir, "msg"),
+                      "w") as msg:
+                msg.write(data)
+
+        self.assertEqual(self.mbox.recalculate(), (30, 2))
+        with open(self.mbox.size_fn) as size:
+            self.assertEqual(size.read(), "\n30 2\n")
+        self.assertEqual(sorted(os.listdir(self.mailbox_dir)),
+                         ["cur", "maildirsize", "new", "tmp"])
+        self.assertEqual(os.listdir(os.path.join(self.mailbox_dir, "tmp")),
+                         [])
+
+    def test_recalculate_reloads_quota(self):
+        """Test that recalculate keeps a quota changed in place by another
+        instance within the timestamp resolution."""
+        self.write_size_file("2000S,20C\n100 1\n")
+        size_stat = os.stat(self.mbox.size_fn)
+        other = QuotaMaildir(self.mailbox_dir, create=False)
+
+        self.mbox.set_quota(1000, 10)
+        os.utime(self.mbox.size_fn,
+                 ns=(size_stat.st_atime_ns, size_stat.st_mtime_ns))
+        other.recalculate()
+
+        with open(self.mbox.size_fn) as size:
+            self.assertEqual(size.read(), "1000S,10C\n0 0\n")
+
+    def test_recalculate_keeps_mode(self):
+        """Test that recalculate keeps the permissions of maildirsize."""
+        self.write_size_file("\n100 1\n")
+        os.chmod(self.mbox.size_fn, 0o660)
+
+        mask = os.umask(0o022)
+        try:
+            self.mbox.recalculate()
+        finally:
+            os.umask(mask)
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.mbox.size_fn).st_mode),
+                         0o660)
+
+    def test_set_quota(self):
+        """Test that set_quota replaces the maildirsize header."""
+        self.write_size_file("\n100 1\n")
+
+        self.mbox.set_quota(1000, 10)
+
+        with open(self.mbox.size_fn) as size:
+            self.assertEqual(size.read(), "1000S,10C\n100 1\n")
+
+    def test_set_quota_in_place(self):
+        """Test that set_quota overwrites a header of the same length."""
+        self.write_size_file("2000S,20C\n100 1\n")
+        size_stat = os.stat(self.mbox.size_fn)
+
+        self.mbox.set_quota(1000, 10)
+
+        with open(self.mbox.size_fn) as size:
+            self.assertEqual(size.read(), "1000S,10C\n100 1\n")
+        self.assertTrue(os.path.samestat(size_stat,
+                                         os.stat(self.mbox.size_fn)))
+
+    def test_recalculate_subfolders(self):
+        """Test that recalculate includes subfolders other than Trash."""
+        for folder in ("one", "two", "Trash"):
+            subfolder = self.mbox.add_folder(folder)
+            with open(os.path.join(subfolder._path, "new", "msg"),
+                      "w") as msg:
+                msg.write("a" * 10)
+
+        self.assertEqual(self.mbox.recalculate(), (20, 2))
+        self.assertEqual(self.mbox.get_folder("one").size(), (10, 1))
+
+    def test_remove_buffered(self):
+        """Test that removals are buffered until the quota is flushed."""
+        key = se_mailbox.SubclassableMaildir.add(self.mbox, _TEST_MSG_OBJ)
+        self.write_size_file("\n100 1\n")
+
+        msg_size = self.mbox.remove(key)
+        with open(self.mbox.size_fn) as size:
+            self.assertEqual(size.read(), "\n100 1\n")
+
+        self.mbox.flush()
+        with open(self.mbox.size_fn) as size:
+            self.assertEqual(size.read(), "\n100 1\n-%d -1\n" % msg_size)
+
+    def test_del_flushes_quota(self):
+        """Test that buffered changes are written if the mailbox is not
+        closed."""
+        self.write_size_file("\n100 1\n")
+        mbox = QuotaMaildir(self.mailbox_dir, create=False)
+        key = se_mailbox.SubclassableMaildir.add(mbox, _TEST_MSG_OBJ)
+
+        msg_size = mbox.remove(key)
+        del mbox
+
+        self.assertEqual(self.mbox.size(), (100 - msg_size, 0))
+
+    def test_del_does_not_wait(self):
+        """Test that buffered changes are skipped, rather than waited for,
+        if the maildirsize file is locked when the mailbox is collected."""
+        self.write_size_file("\n100 1\n")
+        key = se_mailbox.SubclassableMaildir.add(self.mbox, _TEST_MSG_OBJ)
+        self.mbox.remove(key)
+
+        start_time = time.time()
+        with se_mailbox.filelock.DirectFileLock(self.mbox.size_fn):
+            self.mbox.__del__()
+        self.assertLess(time.time() - start_time, 1)
+        with open(self.mbox.size_fn) as size:
+            self.assertEqual(size.read(), "\n100 1\n")
+
+    def test_size_flushes_quota(self):
+        """Test that size includes buffered changes."""
+        key = se_mailbox.SubclassableMaildir.add(self.mbox, _TEST_MSG_OBJ)
+        self.write_size_file("\n100 1\n")
+
+        msg_size = self.mbox.remove(key)
+
+        self.assertEqual(self.mbox.size(), (100 - msg_size, 0))
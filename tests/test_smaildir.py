@@ -1,113 +1,177 @@
-import time
 import unittest
-from mock import patch, MagicMock
+from mock import patch, call
 
 from se_mailbox import smaildir
 
 
+class _FakeEntry(object):
+    """A minimal stand-in for the entries returned by scandir.scandir."""
+    __slots__ = ("name", "_is_dir")
+
+    def __init__(self, name, is_dir=True):
+        self.name = name
+        self._is_dir = is_dir
+
+    def is_dir(self, follow_symlinks=True):
+        return self._is_dir
+
+    def is_file(self, follow_symlinks=True):
+        return not self._is_dir
+
+
+# The current time in the tests that mock time.time.
+_NOW = 1_700_000_000.0
+
+# The mocked scandir.scandir results are never modified, so each name only
+# needs a single entry.
+_ENTRY_CACHE = {}
+
+
 def mock_scandir_values(names):
     """Helper function for mocking scandir.scandir results
-    with given names."""
-    folders = []
+    with given names. Names ending in ".file" are files, and
+    everything else is a directory."""
+    entries = []
     for name in names:
-        # name is an argument to the Mock constructor
-        folder = MagicMock()
-        folder.configure_mock(name=name)
-        folders.append(folder)
-
-    return folders
+        if name not in _ENTRY_CACHE:
+            _ENTRY_CACHE[name] = _FakeEntry(
+                name, is_dir=not name.endswith(".file"))
+        entries.append(_ENTRY_CACHE[name])
+    return entries
 
 
 class TestMaildir(unittest.TestCase):
     """Tests for the smaildir.Maildir class."""
 
+    @classmethod
+    def setUpClass(cls):
+        with patch("se_mailbox.smaildir.os.path.exists", return_value=True):
+            cls.mbox = smaildir.Maildir("/test/path")
+
     def setUp(self):
-        self.mock_scandir = patch("se_mailbox.smaildir.scandir.scandir").start()
-        self.mock_walk = patch("se_mailbox.smaildir.scandir.walk").start()
-        self.mock_isdir = patch("se_mailbox.smaildir.os.path.isdir",
-                                return_value=True).start()
-        self.mock_exists = patch("se_mailbox.smaildir.os.path.exists",
-                                 return_value=True).start()
-        self.mock_remove = patch("se_mailbox.smaildir.os.remove").start()
-        self.mock_rmdir = patch("se_mailbox.smaildir.os.rmdir").start()
-
-    def tearDown(self):
-        patch.stopall()
-
-    def test_list_folders(self):
+        # Reset the table of contents, which some tests change, to the
+        # state of a new instance.
+        self.mbox._toc = {}
+        self.mbox._subdir_tocs = None
+        self.mbox._toc_mtimes = {"cur": 0, "new": 0}
+        self.mbox._last_read = 0
+
+    @patch("se_mailbox.smaildir.scandir.scandir")
+    def test_list_folders(self, mock_scandir):
         """Test list_folders functionality."""
         folders = mock_scandir_values([".", ".spam", ".ham", "test"])
-        self.mock_scandir.return_value = folders
+        mock_scandir.return_value = folders
 
-        result = smaildir.Maildir("/test/path").list_folders()
+        result = self.mbox.list_folders()
         self.assertEqual(result, ["spam", "ham"])
 
-    def test_iter_folders(self):
+    @patch("se_mailbox.smaildir.scandir.scandir")
+    def test_iter_folders(self, mock_scandir):
         """Test iter_folders functionality."""
         folders = mock_scandir_values([".", ".spam", ".ham", "test"])
-        self.mock_scandir.return_value = folders
+        mock_scandir.return_value = folders
 
-        result = smaildir.Maildir("/test/path").iter_folders()
+        result = self.mbox.iter_folders()
         self.assertEqual(list(result), ["spam", "ham"])
 
-    def test_remove_folder(self):
+    @patch("se_mailbox.smaildir.os.close")
+    @patch("se_mailbox.smaildir.os.open")
+    @patch("se_mailbox.smaildir.os.rmdir")
+    @patch("se_mailbox.smaildir.os.remove")
+    @patch("se_mailbox.smaildir.scandir.walk")
+    @patch("se_mailbox.smaildir.scandir.scandir")
+    def test_remove_folder(self, mock_scandir, mock_walk, mock_remove,
+                           mock_rmdir, mock_open, mock_close):
         """Test remove_folder functionality."""
-        # assume there's nothing in any folder (new or cur)
-        # and only the new, cur and tmp subfolders in path
-        folders = mock_scandir_values(["cur", "new", "tmp"])
-        self.mock_scandir.side_effect = [[], [], folders]
-        self.mock_walk.return_value = [("/test/path", ["new", "cur", "tmp"], [])]
-
-        smaildir.Maildir("/test/path").remove_folder("ham")
-
-        self.mock_rmdir.assert_called_with("/test/path/.ham")
-        self.mock_remove.assert_not_called()
-
-    def test_remove_folder_new_messages(self):
-        """Test remove_folder when there are files in the new folder."""
         files = mock_scandir_values(["test_message.file"])
-        self.mock_scandir.return_value = files
-
-        with self.assertRaises(smaildir.mailbox.NotEmptyError):
-            smaildir.Maildir("/test/path").remove_folder("ham")
-
-    def test_remove_folder_cur_messages(self):
-        """Test remove_folder when there are files in the cur folder."""
-        files = mock_scandir_values(["test_message.file"])
-        self.mock_scandir.side_effect = [[], files]
-
-        with self.assertRaises(smaildir.mailbox.NotEmptyError):
-            smaildir.Maildir("/test/path").remove_folder("ham")
-
-    def test_remove_folder_with_subdirectories(self):
-        """Test remove_folder when there are subdirectories in the folder."""
-        names = ["cur", "new", "tmp", "test"]
-        folders = mock_scandir_values(names)
-        self.mock_scandir.side_effect = [[], [], folders]
-
-        with self.assertRaises(smaildir.mailbox.NotEmptyError):
-            smaildir.Maildir("/test/path").remove_folder("ham")
-
-    def test_clean(self):
+        folders = mock_scandir_values(["cur", "new", "tmp"])
+        extra_folders = mock_scandir_values(["cur", "new", "tmp", "test"])
+        # The scandir results for the new, cur and folder directories, and
+        # the error remove_folder should raise.
+        cases = [
+            # assume there's nothing in any folder (new or cur)
+            # and only the new, cur and tmp subfolders in path
+            ("empty", [[], [], folders], None),
+            ("new messages", [files], smaildir.mailbox.NotEmptyError),
+            ("cur messages", [[], files], smaildir.mailbox.NotEmptyError),
+            ("subdirectories", [[], [], extra_folders],
+             smaildir.mailbox.NotEmptyError),
+        ]
+        mock_walk.return_value = [("/test/path", ["new", "cur", "tmp"], [])]
+        mocks = (mock_scandir, mock_remove, mock_rmdir, mock_open, mock_close)
+
+        for name, side_effect, error in cases:
+            with self.subTest(name=name):
+                for mock in mocks:
+                    mock.reset_mock()
+                mock_scandir.side_effect = side_effect
+
+                if error is None:
+                    self.mbox.remove_folder("ham")
+                    self.assertEqual(mock_rmdir.call_args,
+                                     call("/test/path/.ham"))
+                    self.assertEqual(mock_remove.call_count, 0)
+                    self.assertEqual(mock_close.call_args_list,
+                                     [call(mock_open.return_value)])
+                else:
+                    with self.assertRaises(error):
+                        self.mbox.remove_folder("ham")
+                    self.assertEqual(mock_rmdir.call_count, 0)
+
+    @patch("se_mailbox.smaildir.time.time", return_value=_NOW)
+    @patch("se_mailbox.smaildir.os.stat")
+    @patch("se_mailbox.smaildir.os.close")
+    @patch("se_mailbox.smaildir.os.open")
+    @patch("se_mailbox.smaildir.os.remove")
+    @patch("se_mailbox.smaildir.scandir.scandir")
+    def test_clean(self, mock_scandir, mock_remove, mock_open, mock_close,
+                   mock_stat, mock_time):
         """Test clean removes correct path."""
         files = mock_scandir_values(["test.file"])
-        self.mock_scandir.return_value = files
-        expired_timestamp = time.time() - 130000
-        patch("se_mailbox.smaildir.os.path.getatime",
-              return_value=expired_timestamp).start()
-
-        smaildir.Maildir("/test/path").clean()
-
-        self.mock_remove.assert_called_with("/test/path/tmp/test.file")
-
-    def test_clean_not_expired(self):
+        mock_scandir.return_value = files
+        mock_stat.return_value.st_atime = _NOW - 130000
+
+        self.mbox.clean()
+
+        self.assertEqual(mock_open.call_args_list, [call(
+            "/test/path/tmp", smaildir.os.O_RDONLY | smaildir.os.O_DIRECTORY)])
+        self.assertEqual(mock_stat.call_args,
+                         call("test.file", dir_fd=mock_open.return_value))
+        self.assertEqual(mock_remove.call_args,
+                         call("test.file", dir_fd=mock_open.return_value))
+        self.assertEqual(mock_close.call_args_list,
+                         [call(mock_open.return_value)])
+
+    @patch("se_mailbox.smaildir.time.time", return_value=_NOW)
+    @patch("se_mailbox.smaildir.os.stat")
+    @patch("se_mailbox.smaildir.os.close")
+    @patch("se_mailbox.smaildir.os.open")
+    @patch("se_mailbox.smaildir.os.remove")
+    @patch("se_mailbox.smaildir.scandir.scandir")
+    def test_clean_not_expired(self, mock_scandir, mock_remove, mock_open,
+                               mock_close, mock_stat, mock_time):
         """Test clean does not expire recent files."""
         files = mock_scandir_values(["test.file"])
-        self.mock_scandir.return_value = files
-        patch("se_mailbox.smaildir.os.path.getatime",
-              return_value=time.time()).start()
+        mock_scandir.return_value = files
+        mock_stat.return_value.st_atime = _NOW
+
+        self.mbox.clean()
+
+        self.assertEqual(mock_remove.call_count, 0)
 
-        smaildir.Maildir("/test/path").clean()
+    @patch("se_mailbox.smaildir.os.path.getmtime",
+           side_effect=lambda path: 20 if path.endswith("new") else 10)
+    @patch("se_mailbox.smaildir.scandir.scandir")
+    def test_refresh_changed_subdir(self, mock_scandir, mock_getmtime):
+        """Test _refresh only re-reads the subdirectories that changed."""
+        mock_scandir.return_value = [_FakeEntry("msg:2,S", is_dir=False)]
+        self.mbox._subdir_tocs = {"cur": {"old": "cur/old"}, "new": {}}
+        self.mbox._toc_mtimes = {"cur": 10, "new": 10}
+        self.mbox._last_read = 0
 
-        self.mock_remove.assert_not_called()
+        self.mbox._refresh()
 
+        self.assertEqual(mock_scandir.call_args_list,
+                         [call("/test/path/new")])
+        self.assertEqual(self.mbox._toc,
+                         {"old": "cur/old", "msg": "new/msg:2,S"})